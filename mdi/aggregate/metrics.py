@@ -4,36 +4,42 @@ import numpy as np
 import pandas as pd
 
 
-def majority_stance(stances: pd.Series) -> str:
-    """Return majority stance, or 'mixed' if tie, or 'na' if empty."""
-    counts = stances.value_counts()
-    if counts.empty:
-        return "na"
-    top = counts.iloc[0]
-    if (counts == top).sum() > 1:
-        return "mixed"
-    return str(counts.index[0])
-
-
-def avg_strength(series: pd.Series) -> float:
-    if series is None or len(series) == 0:
-        return np.nan
-    return float(pd.to_numeric(series, errors="coerce").mean())
+def majority_stance_by_group(df: pd.DataFrame, by: str = "event_id") -> pd.Series:
+    """
+    Majority stance of every group from a (group x stance) count table:
+    'mixed' on a tie for the top count. Returns a Series indexed by `by`;
+    groups without rows are absent.
+    """
+    counts = df.groupby([by, "stance"], observed=True).size().unstack("stance", fill_value=0)
+    values = counts.to_numpy()
+    if values.size == 0:
+        return pd.Series(dtype=object, index=counts.index)
 
+    top = values.max(axis=1)
+    ties = (values == top[:, None]).sum(axis=1) > 1
+    winner = counts.columns.to_numpy().astype(str)[values.argmax(axis=1)]
+    stance = np.where(top == 0, "na", np.where(ties, "mixed", winner))
+    return pd.Series(stance, index=counts.index)
 
-def top_reasons(reasons_series: pd.Series, k: int = 2) -> str:
+
+def top_reasons_by_group(df: pd.DataFrame, by: str = "event_id", k: int = 2) -> pd.Series:
     """
-    reasons column is expected to be string like "inflation; expectations"
-    or empty/NaN. Returns top-k joined by '; '.
+    Top-k reasons of every group, joined by '; ', in one split/explode pass.
+    reasons are strings like "inflation; expectations" (',' also separates) or empty/NaN.
+    Returns a Series indexed by `by`; groups without any reasons are absent.
+    Ties keep the order of first appearance.
     """
-    items: list[str] = []
-    for r in reasons_series.dropna().astype(str):
-        parts = [p.strip() for p in r.replace(",", ";").split(";")]
-        items += [p for p in parts if p]
-    if not items:
-        return ""
-    vc = pd.Series(items).value_counts()
-    return "; ".join(vc.index[:k].tolist())
+    tmp = df[[by, "reasons"]].dropna()
+    tmp = tmp.assign(reason=tmp["reasons"].astype(str).str.replace(",", ";", regex=False).str.split(";"))
+    tmp = tmp.explode("reason")
+    tmp["reason"] = tmp["reason"].str.strip()
+    tmp = tmp[tmp["reason"].fillna("").ne("")]
+    tmp["order"] = np.arange(len(tmp))
+
+    counts = tmp.groupby([by, "reason"], sort=False).agg(c=("order", "size"), first=("order", "min")).reset_index()
+    counts = counts.sort_values(["c", "first"], ascending=[False, True], kind="stable")
+    top = counts.groupby(by, sort=False).head(k)
+    return top.groupby(by)["reason"].agg("; ".join)
 
 
 def compute_divergence(official_stance: str, media_stance: str) -> float:
@@ -56,3 +62,16 @@ def compute_divergence(official_stance: str, media_stance: str) -> float:
         return np.nan
 
     return float(int(o != m))
+
+
+def compute_divergence_series(official: pd.Series, media: pd.Series) -> pd.Series:
+    """
+    Vectorized compute_divergence over aligned columns (same rules, same output).
+    """
+    allowed = ["hawkish", "dovish", "neutral"]
+    o = official.astype("string").str.lower()
+    m = media.astype("string").str.lower()
+
+    ok = (o.isin(allowed) & m.isin(allowed)).to_numpy(dtype=bool)
+    differ = o.ne(m).fillna(False).to_numpy(dtype=bool)
+    return pd.Series(np.where(ok, differ.astype("float64"), np.nan), index=official.index)
@@ -1,18 +1,58 @@
 from __future__ import annotations
 
 import argparse
+import csv
 from pathlib import Path
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+from pyarrow import csv as pacsv
 
-from openpyxl.styles import Alignment
-from openpyxl.utils import get_column_letter
+from .metrics import majority_stance_by_group, top_reasons_by_group, compute_divergence_series
 
-from .metrics import majority_stance, avg_strength, top_reasons, compute_divergence
+
+# Low-cardinality columns are stored as categoricals: eq/isin compare int codes
+SOURCE_TYPE_DTYPE = pd.CategoricalDtype(["cbr", "media"])
+STANCE_DTYPE = pd.CategoricalDtype(["hawkish", "dovish", "neutral", "mixed", "irrelevant", "na"])
+STATUS_DTYPE = pd.CategoricalDtype(["ok", "failed"])
+
+
+# Only these columns are parsed from the inputs (everything else is skipped at read time)
+EVENT_COLUMNS = ["event_id", "event_date_time", "decision", "new_rate", "cbr_press_url", "cbr_resume_url"]
+ANNOTATION_COLUMNS = [
+    "event_id", "doc_id", "source_type", "source_name", "published_at", "title",
+    "stance", "strength", "reasons", "mentions_key_rate", "evidence", "status",
+]
 
 
 # ---------- I/O ----------
 
+def _csv_header(path: str | Path) -> list[str]:
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        return next(csv.reader(f), [])
+
+
+def _read_csv(path: str | Path, columns: list[str], text_columns: tuple[str, ...] = ()) -> pd.DataFrame:
+    """
+    CSV via pyarrow's multithreaded parser (handles the utf-8 BOM itself).
+    Only `columns` that exist in the file are parsed; `text_columns` are kept
+    as strings instead of letting arrow infer dates. Quoted values may contain
+    newlines (LLM evidence/notes do).
+    """
+    wanted = set(columns)
+    table = pacsv.read_csv(
+        path,
+        read_options=pacsv.ReadOptions(use_threads=True),
+        parse_options=pacsv.ParseOptions(newlines_in_values=True),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=[c for c in _csv_header(path) if c in wanted],
+            strings_can_be_null=True,
+            column_types={c: pa.string() for c in text_columns},
+        ),
+    )
+    return table.to_pandas()
+
+
 def read_events_optional(path: str | None) -> pd.DataFrame | None:
     """
     Optional events table to enrich output (dates, decision, new_rate, links).
@@ -26,34 +66,45 @@ def read_events_optional(path: str | None) -> pd.DataFrame | None:
         raise FileNotFoundError(f"events file not found: {path}")
 
     if p.suffix.lower() in [".xlsx", ".xls"]:
-        df = pd.read_excel(p)
+        df = pd.read_excel(p, usecols=lambda c: c in EVENT_COLUMNS)
     else:
-        df = pd.read_csv(p, encoding="utf-8-sig")
-
-    if "event_id" not in df.columns:
-        if "event_date_time" in df.columns:
-            dt = pd.to_datetime(df["event_date_time"], errors="coerce")
-            df["event_id"] = dt.dt.strftime("cbr_%Y%m%d")
-        else:
-            raise ValueError("events file must contain 'event_id' or 'event_date_time'")
+        df = _read_csv(p, EVENT_COLUMNS, text_columns=("event_id",))
+
+    if "event_id" in df.columns:
+        # annotations keep event_id as text: numeric ids must match them in the join
+        df["event_id"] = df["event_id"].astype(str)
+    elif "event_date_time" in df.columns:
+        dt = pd.to_datetime(df["event_date_time"], errors="coerce")
+        df["event_id"] = dt.dt.strftime("cbr_%Y%m%d")
+    else:
+        raise ValueError("events file must contain 'event_id' or 'event_date_time'")
 
     if "event_date_time" in df.columns:
         df["event_date_time"] = pd.to_datetime(df["event_date_time"], errors="coerce")
 
-    # Keep only useful columns (if exist)
-    keep = [c for c in [
-        "event_id", "event_date_time", "decision", "new_rate", "cbr_press_url", "cbr_resume_url"
-    ] if c in df.columns]
-    return df[keep].copy()
+    # Keep only useful columns (if exist), in a fixed order
+    keep = [c for c in EVENT_COLUMNS if c in df.columns]
+    return df[keep]
+
+
+def _to_category(s: pd.Series, dtype: pd.CategoricalDtype) -> pd.Series:
+    """
+    Cast to the fixed categories of `dtype`; values outside them (e.g. "hawkish ")
+    are appended as extra categories instead of being dropped, so QC still shows them.
+    """
+    unknown = s[s.notna() & ~s.isin(dtype.categories)].unique()
+    if len(unknown):
+        dtype = pd.CategoricalDtype([*dtype.categories, *sorted(unknown)])
+    return s.astype(dtype)
 
 
 def read_annotations(path: str) -> pd.DataFrame:
-    df = pd.read_csv(path, encoding="utf-8-sig")
+    df = _read_csv(path, ANNOTATION_COLUMNS, text_columns=("event_id", "doc_id", "published_at"))
 
     # Normalize core columns
-    df["source_type"] = df["source_type"].astype(str).str.lower()
-    df["stance"] = df["stance"].astype(str).str.lower()
-    df["status"] = df["status"].astype(str).str.lower()
+    # lower() runs in arrow's utf8 kernel; missing values become NaN in the categoricals
+    for col, dtype in [("source_type", SOURCE_TYPE_DTYPE), ("stance", STANCE_DTYPE), ("status", STATUS_DTYPE)]:
+        df[col] = _to_category(df[col].astype("string[pyarrow]").str.lower(), dtype)
 
     if "mentions_key_rate" in df.columns:
         df["mentions_key_rate"] = df["mentions_key_rate"].fillna(False).astype(bool)
@@ -68,81 +119,86 @@ def read_annotations(path: str) -> pd.DataFrame:
     return df
 
 
-# ---------- Excel formatting helpers ----------
+# ---------- Output writers ----------
 
-def _set_auto_filter_and_freeze(ws):
-    ws.freeze_panes = "A2"
-    ws.auto_filter.ref = ws.dimensions
+SHEETS = ("mdi_by_event", "media_qc_by_doc")
 
 
-def _auto_fit_columns(ws, max_width: int = 70):
-    for col_idx, col_cells in enumerate(ws.columns, start=1):
-        max_len = 0
-        for cell in col_cells:
-            v = cell.value
-            if v is None:
-                continue
-            s = str(v)
-            if len(s) > max_len:
-                max_len = len(s)
-        width = min(max_len + 2, max_width)
-        ws.column_dimensions[get_column_letter(col_idx)].width = max(10, width)
+def _column_widths(df: pd.DataFrame, max_width: int = 70) -> list[int]:
+    """Width = longest header/value of each column, measured on the DataFrame (not cell by cell)."""
+    widths = []
+    for col in df.columns:
+        s = df[col]
+        s = s[s.notna()]
+        max_len = int(s.astype(str).str.len().max()) if len(s) else 0
+        max_len = max(max_len, len(str(col)))
+        widths.append(max(10, min(max_len + 2, max_width)))
+    return widths
 
 
-def _wrap_columns(ws, col_names: list[str]):
-    header = [c.value for c in next(ws.iter_rows(min_row=1, max_row=1))]
-    name_to_idx = {name: i for i, name in enumerate(header, start=1)}
-    for name in col_names:
-        idx = name_to_idx.get(name)
-        if not idx:
-            continue
-        for row in ws.iter_rows(min_row=2, min_col=idx, max_col=idx):
-            for cell in row:
-                cell.alignment = Alignment(wrap_text=True, vertical="top")
+def _format_sheet(ws, df: pd.DataFrame, wrap_cols: list[str], wrap_fmt, max_width: int):
+    ws.freeze_panes(1, 0)
+    ws.autofilter(0, 0, len(df), max(len(df.columns) - 1, 0))
+    for i, (col, width) in enumerate(zip(df.columns, _column_widths(df, max_width=max_width))):
+        ws.set_column(i, i, width, wrap_fmt if col in wrap_cols else None)
 
 
 def write_xlsx(mdi_df: pd.DataFrame, media_qc_df: pd.DataFrame, out_path: str):
     out = Path(out_path)
     out.parent.mkdir(parents=True, exist_ok=True)
 
-    with pd.ExcelWriter(out, engine="openpyxl") as writer:
+    # xlsxwriter (faster than openpyxl) still keeps every sheet in memory until the workbook
+    # closes: constant_memory is not used because pandas writes column by column and that
+    # mode only keeps the current row (earlier cells would be dropped)
+    with pd.ExcelWriter(out, engine="xlsxwriter") as writer:
         mdi_df.to_excel(writer, sheet_name="mdi_by_event", index=False)
         media_qc_df.to_excel(writer, sheet_name="media_qc_by_doc", index=False)
 
-        ws1 = writer.sheets["mdi_by_event"]
-        ws2 = writer.sheets["media_qc_by_doc"]
+        # Wrap long text fields
+        wrap = writer.book.add_format({"text_wrap": True, "valign": "top"})
+        _format_sheet(writer.sheets["mdi_by_event"], mdi_df,
+                      ["official_top_reasons", "media_top_reasons", "cbr_press_url", "cbr_resume_url"],
+                      wrap, max_width=55)
+        _format_sheet(writer.sheets["media_qc_by_doc"], media_qc_df, ["title", "evidence"], wrap, max_width=70)
 
-        _set_auto_filter_and_freeze(ws1)
-        _set_auto_filter_and_freeze(ws2)
 
-        # Wrap long text fields
-        _wrap_columns(ws1, ["official_top_reasons", "media_top_reasons", "cbr_press_url", "cbr_resume_url"])
-        _wrap_columns(ws2, ["title", "evidence"])
+def feather_paths(out_path: str) -> dict[str, Path]:
+    """data/out/mdi_outputs.xlsx -> data/out/mdi_outputs_<sheet>.feather"""
+    out = Path(out_path)
+    return {sheet: out.with_name(f"{out.stem}_{sheet}.feather") for sheet in SHEETS}
 
-        _auto_fit_columns(ws1, max_width=55)
-        _auto_fit_columns(ws2, max_width=70)
+
+def write_feather(mdi_df: pd.DataFrame, media_qc_df: pd.DataFrame, out_path: str) -> list[Path]:
+    paths = feather_paths(out_path)
+    paths["mdi_by_event"].parent.mkdir(parents=True, exist_ok=True)
+    mdi_df.reset_index(drop=True).to_feather(paths["mdi_by_event"])
+    media_qc_df.reset_index(drop=True).to_feather(paths["media_qc_by_doc"])
+    return list(paths.values())
 
 
 # ---------- Aggregation ----------
 
 def build_media_qc(media: pd.DataFrame) -> pd.DataFrame:
-    m = media.copy()
-    m["ok"] = m["status"].eq("ok")
-    m["usable"] = m["ok"] & m["mentions_key_rate"] & ~m["stance"].isin(["irrelevant"])
-
-    m["excluded_reason"] = ""
-    m.loc[~m["ok"], "excluded_reason"] = "status_not_ok"
-    m.loc[m["ok"] & ~m["mentions_key_rate"], "excluded_reason"] = "mentions_key_rate_false"
-    m.loc[m["ok"] & m["mentions_key_rate"] & m["stance"].isin(["irrelevant"]), "excluded_reason"] = "stance_irrelevant"
-    m.loc[m["usable"], "excluded_reason"] = ""
+    ok = media["status"].eq("ok").to_numpy(dtype=bool)
+    mkr = media["mentions_key_rate"].to_numpy(dtype=bool)
+    irr = media["stance"].eq("irrelevant").to_numpy(dtype=bool)
+
+    # first matching reason wins; usable docs fall through to ""
+    excluded_reason = np.select(
+        [~ok, ~mkr, irr],
+        ["status_not_ok", "mentions_key_rate_false", "stance_irrelevant"],
+        default="",
+    )
 
-    # Keep only informative columns for human audit
+    # Keep only informative columns for human audit (the only columns that get copied)
     cols = [
         "event_id", "doc_id", "published_at", "source_name", "title",
         "stance", "strength", "mentions_key_rate", "status", "excluded_reason", "evidence"
     ]
-    cols = [c for c in cols if c in m.columns]
-    out = m[cols].copy()
+    out = pd.DataFrame({
+        c: excluded_reason if c == "excluded_reason" else media[c]
+        for c in cols if c == "excluded_reason" or c in media.columns
+    })
 
     # Sort for readability
     return out.sort_values(["event_id", "source_name", "published_at", "doc_id"], na_position="last")
@@ -152,67 +208,67 @@ def aggregate(events_path: str | None, annotations_path: str) -> tuple[pd.DataFr
     events = read_events_optional(events_path)
     ann = read_annotations(annotations_path)
 
+    # Flags: computed once on the full table, so cbr/media below are read-only selections (no copies)
+    ann["ok"] = ann["status"].eq("ok")
+    ann["usable"] = ann["ok"] & ann["mentions_key_rate"] & ~ann["stance"].isin(["irrelevant"])
+    ann["ok_relevant"] = ann["ok"] & ann["mentions_key_rate"]
+    ann["strength_num"] = pd.to_numeric(ann["strength"], errors="coerce")
+    # strength of usable docs only, so the media average fits into the same groupby as the counters
+    ann["strength_used"] = ann["strength_num"].where(ann["usable"])
+
     # Split
-    cbr = ann[ann["source_type"] == "cbr"].copy()
-    media = ann[ann["source_type"] == "media"].copy()
-
-    # Flags
-    cbr["ok"] = cbr["status"].eq("ok")
-    cbr["usable"] = cbr["ok"] & cbr["mentions_key_rate"] & ~cbr["stance"].isin(["irrelevant"])
-
-    media["ok"] = media["status"].eq("ok")
-    media["usable"] = media["ok"] & media["mentions_key_rate"] & ~media["stance"].isin(["irrelevant"])
-
-    # Official aggregation (usually 1 doc per event)
-    official_rows = []
-    for event_id, g in cbr.groupby("event_id"):
-        g_used = g[g["usable"]]
-
-        stance = g_used["stance"].iloc[0] if len(g_used) else "na"
-        strength = float(pd.to_numeric(g_used["strength"], errors="coerce").iloc[0]) if len(g_used) else np.nan
-
-        official_rows.append({
-            "event_id": event_id,
-            "n_cbr_used": int(len(g_used)),
-            "official_stance": stance,
-            "official_strength": strength,
-            "official_top_reasons": top_reasons(g_used.get("reasons", pd.Series(dtype=str)), k=2),
-        })
-    official = pd.DataFrame(official_rows)
-
-    # Media aggregation
-    media_rows = []
-    for event_id, g in media.groupby("event_id"):
-        g_ok = g[g["ok"]]
-        g_used = g[g["usable"]]
-
-        media_rows.append({
-            "event_id": event_id,
-            "n_media_total": int(len(g)),
-            "n_media_ok": int(len(g_ok)),
-            "n_media_used": int(len(g_used)),
-            "media_relevance_rate": float(g_ok["mentions_key_rate"].mean()) if len(g_ok) else np.nan,
-            "media_stance": majority_stance(g_used["stance"]),
-            "media_strength_avg": avg_strength(g_used["strength"]),
-            "media_top_reasons": top_reasons(g_used.get("reasons", pd.Series(dtype=str)), k=2),
-        })
-    media_agg = pd.DataFrame(media_rows)
+    cbr = ann[ann["source_type"] == "cbr"]
+    media = ann[ann["source_type"] == "media"]
+
+    # Official aggregation (usually 1 doc per event): the first usable doc gives stance/strength
+    cbr_used = cbr[cbr["usable"]]
+    official_first = (
+        cbr_used.drop_duplicates("event_id")
+            .set_index("event_id")[["stance", "strength_num"]]
+            .rename(columns={"stance": "official_stance", "strength_num": "official_strength"})
+    )
+    official = (
+        cbr.groupby("event_id").agg(n_cbr_used=("usable", "sum"))
+            .join(official_first)
+            .join(top_reasons_by_group(cbr_used, k=2).rename("official_top_reasons"))
+    )
+    official["official_stance"] = official["official_stance"].fillna("na")
+    official["official_top_reasons"] = official["official_top_reasons"].fillna("")
+
+    # Media aggregation: one pass for counters + strength, stance/reasons over usable docs only
+    media_counts = media.groupby("event_id").agg(
+        n_media_total=("doc_id", "size"),
+        n_media_ok=("ok", "sum"),
+        n_media_used=("usable", "sum"),
+        n_media_ok_relevant=("ok_relevant", "sum"),
+        media_strength_avg=("strength_used", "mean"),
+    )
+    # share of mentions_key_rate among ok docs (NaN if no ok docs)
+    media_counts["media_relevance_rate"] = (
+        media_counts["n_media_ok_relevant"] / media_counts["n_media_ok"].where(media_counts["n_media_ok"] > 0)
+    )
+    media_used = media[media["usable"]]
+    media_agg = (
+        media_counts.drop(columns="n_media_ok_relevant")
+            .join(majority_stance_by_group(media_used).rename("media_stance"))
+            .join(top_reasons_by_group(media_used, k=2).rename("media_top_reasons"))
+    )
+    media_agg["media_stance"] = media_agg["media_stance"].fillna("na")
+    media_agg["media_top_reasons"] = media_agg["media_top_reasons"].fillna("")
 
     # Base event table for output:
     if events is None:
         # If no events table, build minimal event table from annotations
         base = pd.DataFrame({"event_id": sorted(ann["event_id"].dropna().astype(str).unique().tolist())})
     else:
-        base = events.copy()
+        base = events
 
-    mdi = (
-        base.merge(official, on="event_id", how="left")
-            .merge(media_agg, on="event_id", how="left")
-    )
+    # Both aggregates are indexed by event_id: combine them, then a single join into the base table
+    mdi = base.join(official.join(media_agg, how="outer"), on="event_id")
 
-    mdi["divergence_stance"] = mdi.apply(
-        lambda r: compute_divergence(r.get("official_stance"), r.get("media_stance")),
-        axis=1
+    mdi["divergence_stance"] = compute_divergence_series(
+        mdi.get("official_stance", pd.Series(np.nan, index=mdi.index)),
+        mdi.get("media_stance", pd.Series(np.nan, index=mdi.index)),
     )
 
     # Keep ONLY useful columns for quick evaluation
@@ -236,10 +292,10 @@ def aggregate(events_path: str | None, annotations_path: str) -> tuple[pd.DataFr
         "cbr_resume_url",
     ]
     mdi_cols = [c for c in mdi_cols if c in mdi.columns]
-    mdi = mdi[mdi_cols].copy()
+    mdi = mdi[mdi_cols]
 
     if "event_date_time" in mdi.columns:
-        mdi = mdi.sort_values("event_date_time")
+        mdi = mdi.sort_values("event_date_time", ignore_index=True)
 
     media_qc = build_media_qc(media)
     return mdi, media_qc
@@ -252,13 +308,19 @@ def main():
     ap.add_argument("--ann", required=True, help="Path to annotations csv (e.g., data/out/annotations_v2.csv)")
     ap.add_argument("--events", default=None, help="Optional events file (csv/xlsx) to add date/decision/rate/urls")
     ap.add_argument("--out_xlsx", default="data/out/mdi_outputs.xlsx", help="Output Excel path (2 sheets)")
+    ap.add_argument("--format", choices=["xlsx", "arrow", "both"], default="xlsx",
+                    help="xlsx: Excel only; arrow: one .feather per sheet next to --out_xlsx; both: all of them")
     args = ap.parse_args()
 
     mdi_df, media_qc_df = aggregate(args.events, args.ann)
-    write_xlsx(mdi_df, media_qc_df, args.out_xlsx)
 
-    print(f"Saved Excel: {args.out_xlsx}")
-    print("Sheets: mdi_by_event, media_qc_by_doc")
+    if args.format in ("xlsx", "both"):
+        write_xlsx(mdi_df, media_qc_df, args.out_xlsx)
+        print(f"Saved Excel: {args.out_xlsx}")
+        print("Sheets: " + ", ".join(SHEETS))
+    if args.format in ("arrow", "both"):
+        for p in write_feather(mdi_df, media_qc_df, args.out_xlsx):
+            print(f"Saved Feather: {p}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import hashlib
+import threading
+from typing import Any, Dict, Optional
+
+import orjson
+
+from .io import ensure_dir
+from .prompts import PROMPT_VERSION
+
+
+class LLMCache:
+    """
+    Exact-match cache of parsed LLM annotations (SQLite file).
+    Key = sha256 of (model, temperature, prompt version, source_type, text sent to the model),
+    so changing the model or the prompt invalidates old entries automatically.
+    Only meaningful for deterministic calls (temperature == 0).
+    """
+
+    def __init__(self, path: str, model: str, temperature: float):
+        ensure_dir(path)
+        self.model = model
+        self.temperature = temperature
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY,"
+            " parsed TEXT NOT NULL,"
+            " created_at TEXT DEFAULT CURRENT_TIMESTAMP)"
+        )
+        self._conn.commit()
+
+    def key(self, doc: Dict[str, Any]) -> str:
+        payload = {
+            "model": self.model,
+            "t": self.temperature,
+            "v": PROMPT_VERSION,
+            "src": doc["source_type"],
+            "txt": doc["text_focus"],
+        }
+        # stdlib json on purpose: the key bytes must stay stable, or existing caches go cold;
+        # surrogatepass keeps texts with broken surrogates hashable
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8", "surrogatepass")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT parsed FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        return orjson.loads(row[0]) if row else None
+
+    def put(self, key: str, parsed: Dict[str, Any]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO llm_cache (key, parsed) VALUES (?, ?)",
+                (key, orjson.dumps(parsed).decode()),
+            )
+            self._conn.commit()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -1,14 +1,16 @@
 from __future__ import annotations
 
-import json
-import time
+import random
+import asyncio
 from typing import Any, Dict, TypedDict, Optional
 
+import orjson
 from langgraph.graph import StateGraph, START, END
 from pydantic import ValidationError
 
 from .schema import LLMAnnotation
 from .prompts import build_prompt
+from .ratelimit import TokenBucket
 
 
 class State(TypedDict, total=False):
@@ -22,12 +24,40 @@ class State(TypedDict, total=False):
 
 
 def _extract_json(text: str) -> str:
-    """Try to cut out a JSON object from a model response."""
+    """
+    Try to cut out a JSON object from a model response: the first balanced {...}
+    (braces inside strings are ignored), so trailing prose or ``` does not break parsing.
+    """
     if not text:
         return ""
     start = text.find("{")
+    if start == -1:
+        return text.strip()
+
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1].strip()
+
+    # unbalanced (e.g. truncated answer): old behaviour, let the parser report the error
     end = text.rfind("}")
-    if start == -1 or end == -1 or end <= start:
+    if end <= start:
         return text.strip()
     return text[start:end + 1].strip()
 
@@ -42,13 +72,19 @@ def _is_timeout_error(msg: str) -> bool:
     return ("timeout" in m) or ("timed out" in m) or ("connecttimeout" in m)
 
 
-def make_graph(llm) -> Any:
+def make_graph(llm, limiter: Optional[TokenBucket] = None) -> Any:
     """
     Graph: annotate -> validate -> (repair -> validate)* -> end
     We also handle network/rate-limit errors inside annotate node.
+    LLM nodes are async: run the graph with `await graph.ainvoke(state)`.
+    Every LLM request (annotate and repair) first takes a token from the shared `limiter`.
     """
 
-    def annotate_node(state: State) -> State:
+    async def throttle() -> None:
+        if limiter is not None:
+            await limiter.acquire()
+
+    async def annotate_node(state: State) -> State:
         row = state["row"]
 
         prompt = build_prompt(
@@ -59,11 +95,6 @@ def make_graph(llm) -> Any:
             text=row["text_focus"],
         )
 
-        # Throttle: small sleep before each request (helps avoid 429)
-        sleep_sec = float(row.get("_sleep_sec", 0.0) or 0.0)
-        if sleep_sec > 0:
-            time.sleep(sleep_sec)
-
         # Retry on 429 / transient errors
         max_req_retries = int(row.get("_request_retries", 4) or 4)
         base_backoff = float(row.get("_backoff_base_sec", 5.0) or 5.0)
@@ -71,7 +102,8 @@ def make_graph(llm) -> Any:
         last_err: Optional[str] = None
         for i in range(max_req_retries):
             try:
-                res = llm.invoke(prompt)
+                await throttle()
+                res = await llm.ainvoke(prompt)
                 raw = getattr(res, "content", None)
                 if raw is None:
                     raw = str(res)
@@ -80,14 +112,14 @@ def make_graph(llm) -> Any:
                 msg = str(e)
                 last_err = msg
 
-                # Rate limit -> backoff and retry
+                # Rate limit -> exponential backoff with jitter (workers do not retry in lockstep)
                 if _is_rate_limit_error(msg):
-                    time.sleep(base_backoff * (i + 1))
+                    await asyncio.sleep(base_backoff * 2 ** i + random.uniform(0, base_backoff))
                     continue
 
                 # Timeout sometimes transient -> short retry
                 if _is_timeout_error(msg):
-                    time.sleep(2.0 * (i + 1))
+                    await asyncio.sleep(2.0 * (i + 1))
                     continue
 
                 # Other errors: do not retry by default
@@ -105,8 +137,8 @@ def make_graph(llm) -> Any:
         json_text = _extract_json(raw)
 
         try:
-            obj = json.loads(json_text)
-        except Exception as e:
+            obj = orjson.loads(json_text)
+        except orjson.JSONDecodeError as e:
             return {"parsed": None, "error": f"json.loads failed: {e.__class__.__name__}: {e}"}
 
         try:
@@ -116,7 +148,7 @@ def make_graph(llm) -> Any:
 
         return {"parsed": ann.model_dump(), "error": ""}
 
-    def repair_node(state: State) -> State:
+    async def repair_node(state: State) -> State:
         attempt = int(state.get("attempt", 0)) + 1
         max_retries = int(state.get("max_retries", 2))
 
@@ -140,7 +172,8 @@ def make_graph(llm) -> Any:
         )
 
         try:
-            res = llm.invoke(repair_prompt)
+            await throttle()
+            res = await llm.ainvoke(repair_prompt)
             fixed = getattr(res, "content", None)
             if fixed is None:
                 fixed = str(res)
@@ -1,8 +1,13 @@
 from __future__ import annotations
 
 import os
+import csv
+import atexit
+import hashlib
+import threading
+import numpy as np
 import pandas as pd
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, TextIO
 
 
 def read_table(path: str) -> pd.DataFrame:
@@ -27,19 +32,31 @@ def normalize_text(s: Optional[str]) -> str:
     return s.strip()
 
 
-def build_text_focus(title: str, lead: str, text: str, max_chars: int) -> str:
-    # Даем модели заголовок+лид и затем тело (обрезаем по max_chars)
-    parts = []
-    if title:
-        parts.append(f"ЗАГОЛОВОК: {title}")
-    if lead:
-        parts.append(f"ЛИД: {lead}")
-    if text:
-        parts.append(f"ТЕКСТ:\n{text}")
-    joined = "\n\n".join(parts).strip()
-    if len(joined) > max_chars:
-        joined = joined[:max_chars]
-    return joined
+def text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _normalize_text_col(s: pd.Series) -> pd.Series:
+    """Column version of normalize_text (missing -> "")."""
+    return (
+        s.astype(object).where(s.notna(), "").astype(str)
+            .str.replace("\r\n", "\n", regex=False)
+            .str.replace("\r", "\n", regex=False)
+            .str.strip()
+    )
+
+
+def _text_focus_col(title: pd.Series, lead: pd.Series, text: pd.Series, max_chars: int) -> pd.Series:
+    """
+    Text for the model: "ЗАГОЛОВОК: title", "ЛИД: lead", "ТЕКСТ:\n text" — non-empty parts
+    joined by a blank line, cut to max_chars.
+    """
+    joined = pd.Series("", index=title.index, dtype=object)
+    for prefix, part in (("ЗАГОЛОВОК: ", title), ("ЛИД: ", lead), ("ТЕКСТ:\n", text)):
+        has_part = part.ne("")
+        sep = np.where(joined.ne("") & has_part, "\n\n", "")
+        joined = joined + sep + (prefix + part).where(has_part, "")
+    return joined.str.strip().str.slice(0, max_chars)
 
 
 def load_documents(df: pd.DataFrame, colmap: Dict[str, str], max_chars: int) -> list[dict[str, Any]]:
@@ -48,54 +65,104 @@ def load_documents(df: pd.DataFrame, colmap: Dict[str, str], max_chars: int) ->
         if k not in colmap:
             raise ValueError(f"Missing column mapping for '{k}' in config")
 
-    rows: list[dict[str, Any]] = []
-    for _, r in df.iterrows():
-        event_id = str(r[colmap["event_id"]]).strip()
-        doc_id = str(r[colmap["doc_id"]]).strip()
+    def col(key: str) -> pd.Series:
+        name = colmap[key]
+        if name in df.columns:
+            return df[name]
+        # title/lead/text may be absent in the table; ids may not
+        if key in ("title", "lead", "text"):
+            return pd.Series("", index=df.index, dtype=object)
+        raise KeyError(name)
 
-        source_type = str(r[colmap["source_type"]]).strip().lower()
-        source_name = str(r[colmap["source_name"]]).strip()
+    out = pd.DataFrame(index=df.index)
+    out["event_id"] = _normalize_text_col(col("event_id"))
+    out["doc_id"] = _normalize_text_col(col("doc_id"))
+    out["source_type"] = _normalize_text_col(col("source_type")).str.lower()
+    out["source_name"] = _normalize_text_col(col("source_name"))
 
-        published_at = None
-        if "published_at" in colmap and colmap["published_at"] in df.columns:
-            val = r[colmap["published_at"]]
-            if pd.notna(val):
-                published_at = str(val)
+    out["published_at"] = None
+    if "published_at" in colmap and colmap["published_at"] in df.columns:
+        val = df[colmap["published_at"]]
+        out.loc[val.notna(), "published_at"] = val[val.notna()].map(str)
 
-        title = normalize_text(r.get(colmap["title"], ""))
-        lead = normalize_text(r.get(colmap["lead"], ""))
-        text = normalize_text(r.get(colmap["text"], ""))
+    out["title"] = _normalize_text_col(col("title"))
+    out["lead"] = _normalize_text_col(col("lead"))
+    text = _normalize_text_col(col("text"))
 
-        text_focus = build_text_focus(title, lead, text, max_chars=max_chars)
+    out["text_focus"] = _text_focus_col(out["title"], out["lead"], text, max_chars=max_chars)
+    return out.astype(object).to_dict(orient="records")
 
-        rows.append({
-            "event_id": event_id,
-            "doc_id": doc_id,
-            "source_type": source_type,
-            "source_name": source_name,
-            "published_at": published_at,
-            "title": title,
-            "lead": lead,
-            "text_focus": text_focus,
-        })
-    return rows
 
-
-def read_existing_annotations(path: str) -> set[str]:
+def read_existing_annotations(path: str) -> frozenset[str]:
+    """doc_ids already present in the output file (only that column is parsed)."""
     if not os.path.exists(path):
-        return set()
-    df = pd.read_csv(path)
+        return frozenset()
+    df = pd.read_csv(path, usecols=lambda c: c == "doc_id", dtype=str)
     if "doc_id" not in df.columns:
-        return set()
-    return set(df["doc_id"].astype(str).tolist())
-
-
-def append_output_row(path: str, row: dict[str, Any]) -> None:
-    ensure_dir(path)
-    import pandas as pd
+        return frozenset()
+    return frozenset(df["doc_id"].dropna().tolist())
+
+
+class AnnotationSink:
+    """
+    Buffered CSV appender for annotation rows (safe to share between threads).
+    Rows are written every `flush_every` rows, by a background timer every `flush_interval`
+    seconds (so finished rows reach the file even while workers sit in a long backoff),
+    on close() and at interpreter exit; the header is written only when the file is new.
+    """
+
+    def __init__(self, path: str, flush_every: int = 64, flush_interval: float = 1.0):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._buffer: list[dict[str, Any]] = []
+        self._file: Optional[TextIO] = None
+        self._writer: Optional[csv.DictWriter] = None
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._timer = threading.Thread(target=self._flush_periodically, name="annotation-sink-flush", daemon=True)
+        self._timer.start()
+        atexit.register(self.close)
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def _open(self, fieldnames: list[str]) -> None:
+        ensure_dir(self.path)
+        is_new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        # utf-8-sig writes the BOM only at the start of a new file
+        self._file = open(self.path, "a", newline="", encoding="utf-8-sig")
+        self._writer = csv.DictWriter(self._file, fieldnames=fieldnames, lineterminator="\n")
+        if is_new:
+            self._writer.writeheader()
+
+    def add(self, row: dict[str, Any]) -> None:
+        with self._lock:
+            self._buffer.append(row)
+            if len(self._buffer) >= self.flush_every:
+                self._flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self._buffer:
+            return
+        if self._writer is None:
+            self._open(list(self._buffer[0].keys()))
+        self._writer.writerows(self._buffer)
+        self._file.flush()
+        self._buffer.clear()
+
+    def close(self) -> None:
+        self._closed.set()
+        with self._lock:
+            self._flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                self._writer = None
+        atexit.unregister(self.close)
 
-    out_df = pd.DataFrame([row])
-    if os.path.exists(path):
-        out_df.to_csv(path, mode="a", header=False, index=False, encoding="utf-8-sig")
-    else:
-        out_df.to_csv(path, index=False, encoding="utf-8-sig")
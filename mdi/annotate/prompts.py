@@ -3,6 +3,11 @@ from __future__ import annotations
 import json
 from textwrap import dedent
 
+import orjson
+
+# Версия промпта: увеличивать при любом изменении CODEBOOK/SYSTEM/схемы (ключ кэша LLM)
+PROMPT_VERSION = "1"
+
 # Мини-кодбук прямо в промпте (чтобы не зависеть от файлов)
 CODEBOOK = dedent("""
 Ты размечаешь тексты о денежно-кредитной политике (ДКП) и ключевой ставке.
@@ -38,32 +43,41 @@ SYSTEM = dedent("""
 """)
 
 
-def build_prompt(source_type: str, source_name: str, title: str | None, lead: str | None, text: str) -> str:
-    schema_hint = {
-        "stance": "hawkish|dovish|neutral|mixed|irrelevant",
-        "strength": 0,
-        "reasons": ["..."],
-        "mentions_key_rate": True,
-        "evidence": ["..."],
-        "notes": "..."
-    }
+SCHEMA_HINT = {
+    "stance": "hawkish|dovish|neutral|mixed|irrelevant",
+    "strength": 0,
+    "reasons": ["..."],
+    "mentions_key_rate": True,
+    "evidence": ["..."],
+    "notes": "..."
+}
 
-    payload = {
-        "source_type": source_type,
-        "source_name": source_name,
-        "title": title or "",
-        "lead": lead or "",
-        "text": text,
-    }
 
-    return dedent(f"""
+# Everything before the document payload is the same for every call: render it once.
+# (SYSTEM/CODEBOOK are not indented, so dedent keeps the 4-space margin of the template lines)
+_PROMPT_PREFIX = dedent(f"""
     {SYSTEM}
 
     {CODEBOOK}
 
     Верни JSON по этой схеме (пример структуры, не значения):
-    {json.dumps(schema_hint, ensure_ascii=False)}
+    {json.dumps(SCHEMA_HINT, ensure_ascii=False)}
 
     Текст для разметки (JSON с полями source/title/lead/text):
-    {json.dumps(payload, ensure_ascii=False)}
-    """).strip()
+    """).lstrip() + "    "
+
+
+def build_prompt(source_type: str, source_name: str, title: str | None, lead: str | None, text: str) -> str:
+    payload = {
+        "source_type": source_type,
+        "source_name": source_name,
+        "title": title or "",
+        "lead": lead or "",
+        "text": text,
+    }
+    try:
+        payload_json = orjson.dumps(payload).decode()
+    except TypeError:
+        # orjson rejects lone surrogates (broken source text); stdlib json passes them through
+        payload_json = json.dumps(payload, ensure_ascii=False)
+    return _PROMPT_PREFIX + payload_json
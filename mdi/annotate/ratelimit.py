@@ -0,0 +1,32 @@
+from __future__ import annotations
+
+import time
+import asyncio
+
+
+class TokenBucket:
+    """
+    Request rate limiter shared by all workers of one event loop.
+    On average at most `rate` acquisitions per second; up to `burst` may go back to back
+    after an idle period. Waiters are served in arrival order.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        if rate <= 0:
+            raise ValueError(f"rate must be > 0, got {rate}")
+        self.rate = rate
+        self.capacity = float(max(1, burst))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self._tokens) / self.rate)
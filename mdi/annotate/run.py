@@ -1,17 +1,25 @@
 from __future__ import annotations
 
 import os
+import re
 import argparse
+import asyncio
 import yaml
-import time
+from collections import Counter, defaultdict
+import orjson
+from pydantic import ValidationError
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from langchain_gigachat.chat_models import GigaChat
 
-from .io import read_table, load_documents, read_existing_annotations, append_output_row, normalize_text
+from .io import read_table, load_documents, read_existing_annotations, AnnotationSink, normalize_text, text_hash
+from .cache import LLMCache
 from .graph import make_graph
-from .schema import OutputRow
+from .ratelimit import TokenBucket
+from .schema import STANCES, LLMAnnotation
+
+# docs in flight at once; the request rate is capped separately by the token bucket
+DEFAULT_MAX_INFLIGHT = 16
 
 
 def load_config(path: str) -> dict:
@@ -38,6 +46,15 @@ def init_llm(cfg: dict):
     )
 
 
+# common tails ("Читайте также" etc.); text is cut at the first such marker past _CUT_MIN_POS
+_CUT_RE = re.compile(
+    r"\n(Читайте также|Подписывайтесь|Реклама|Материал подготовлен|Источник:|Смотрите также)",
+    re.IGNORECASE,
+)
+_CUT_MIN_POS = 200
+_SPACES_RE = re.compile(r" {2,}")
+
+
 def _sanitize_text_for_llm(text: str) -> str:
     """
     Reduce blacklist risk and noise:
@@ -47,19 +64,16 @@ def _sanitize_text_for_llm(text: str) -> str:
     """
     t = normalize_text(text)
 
-    # cut common tails
-    cut_markers = [
-        "\nЧитайте также",
-        "\nПодписывайтесь",
-        "\nРеклама",
-        "\nМатериал подготовлен",
-        "\nИсточник:",
-        "\nСмотрите также",
-    ]
-    for m in cut_markers:
-        idx = t.lower().find(m.lower())
-        if idx != -1 and idx > 200:
-            t = t[:idx].strip()
+    # cut common tails: only the first occurrence of each marker counts
+    seen: set[str] = set()
+    for m in _CUT_RE.finditer(t):
+        marker = m.group(1).lower()
+        if marker in seen:
+            continue
+        if m.start() > _CUT_MIN_POS:
+            t = t[:m.start()].strip()
+            break
+        seen.add(marker)
 
     # remove huge URL lists
     lines = []
@@ -77,66 +91,155 @@ def _sanitize_text_for_llm(text: str) -> str:
     t = "\n".join(lines).strip()
 
     # compress overly long spaces
-    while "  " in t:
-        t = t.replace("  ", " ")
-    return t
+    return _SPACES_RE.sub(" ", t)
 
 
-def to_output_row(doc: dict, parsed: dict | None, annotator: str, attempts: int, error: str | None) -> dict:
-    status = "ok" if parsed else "failed"
+# Section headers written by io._text_focus_col: shared by every doc, never boilerplate
+_SECTION_PREFIXES = ("ЗАГОЛОВОК:", "ЛИД:", "ТЕКСТ:")
+BOILERPLATE_PLACEHOLDER = "[...]"
+
+
+def find_boilerplate_lines(texts: list[str], min_share: float, min_docs: int, min_len: int = 20) -> set[str]:
+    """
+    Lines (disclaimers, "о компании" footers, ...) that occur in more than `min_share`
+    of the distinct texts of the batch. Needs at least `min_docs` distinct texts,
+    otherwise a small batch would treat any shared line as boilerplate.
+    """
+    unique_texts = set(texts)
+    if min_share <= 0 or len(unique_texts) < min_docs:
+        return set()
+
+    counts: Counter[str] = Counter()
+    for t in unique_texts:
+        lines = {ln.strip() for ln in t.split("\n")}
+        counts.update(ln for ln in lines if len(ln) >= min_len and not ln.startswith(_SECTION_PREFIXES))
+
+    threshold = min_share * len(unique_texts)
+    return {ln for ln, c in counts.items() if c > threshold}
+
+
+def _drop_boilerplate_lines(text: str, boilerplate: set[str]) -> str:
+    """Replace each run of boilerplate lines with a single placeholder line."""
+    if not boilerplate:
+        return text
+    out: list[str] = []
+    for line in text.split("\n"):
+        if line.strip() in boilerplate:
+            if not out or out[-1] != BOILERPLATE_PLACEHOLDER:
+                out.append(BOILERPLATE_PLACEHOLDER)
+            continue
+        out.append(line)
+    return "\n".join(out)
+
 
+def to_output_row(doc: dict, parsed: dict | None, annotator: str, attempts: int, error: str | None) -> dict:
+    """
+    Output CSV row (columns as in schema.OutputRow). Built as a plain dict:
+    `parsed` has already been validated against LLMAnnotation in the graph.
+    """
     if parsed:
+        if parsed["stance"] not in STANCES:
+            raise ValueError(f"Unexpected stance: {parsed['stance']!r}")
+        stance = parsed["stance"]
+        strength = int(parsed["strength"])
         reasons = "; ".join(parsed.get("reasons", []) or [])
+        mentions_key_rate = bool(parsed["mentions_key_rate"])
         evidence = " ||| ".join(parsed.get("evidence", []) or [])
         notes = parsed.get("notes")
-        out = OutputRow(
-            event_id=doc["event_id"],
-            doc_id=doc["doc_id"],
-            source_type=doc["source_type"],
-            source_name=doc["source_name"],
-            published_at=doc.get("published_at"),
-            title=doc.get("title"),
-            stance=parsed["stance"],
-            strength=int(parsed["strength"]),
-            reasons=reasons,
-            mentions_key_rate=bool(parsed["mentions_key_rate"]),
-            evidence=evidence,
-            notes=notes,
-            annotator=annotator,
-            attempts=attempts,
-            status=status,
-            error=None,
-        )
+        status = "ok"
+        error = None
     else:
-        out = OutputRow(
-            event_id=doc["event_id"],
-            doc_id=doc["doc_id"],
-            source_type=doc["source_type"],
-            source_name=doc["source_name"],
-            published_at=doc.get("published_at"),
-            title=doc.get("title"),
-            stance="irrelevant",
-            strength=0,
-            reasons="",
-            mentions_key_rate=False,
-            evidence="",
-            notes=None,
-            annotator=annotator,
-            attempts=attempts,
-            status=status,
-            error=error or "unknown error",
-        )
-
-    return out.model_dump()
-
-
-def process_one(graph, doc: dict, max_retries: int, annotator: str) -> dict:
+        stance, strength, reasons, mentions_key_rate, evidence, notes = "irrelevant", 0, "", False, "", None
+        status = "failed"
+        error = error or "unknown error"
+
+    return {
+        "event_id": doc["event_id"],
+        "doc_id": doc["doc_id"],
+        "source_type": doc["source_type"],
+        "source_name": doc["source_name"],
+        "published_at": doc.get("published_at"),
+        "title": doc.get("title"),
+        "stance": stance,
+        "strength": strength,
+        "reasons": reasons,
+        "mentions_key_rate": mentions_key_rate,
+        "evidence": evidence,
+        "notes": notes,
+        "annotator": annotator,
+        "attempts": attempts,
+        "status": status,
+        "error": error,
+    }
+
+
+async def process_one(graph, doc: dict, max_retries: int,
+                      cache: LLMCache | None = None) -> tuple[dict | None, int, str | None]:
+    """Annotate one document: returns (parsed, attempts, error)."""
+    key = cache.key(doc) if cache is not None else None
+    if cache is not None:
+        try:
+            hit = cache.get(key)
+            if hit is not None:
+                # same text was already annotated (this run or earlier): no LLM call
+                return LLMAnnotation.model_validate(hit).model_dump(), 0, None
+        except (orjson.JSONDecodeError, ValidationError) as e:
+            # corrupt or outdated row: drop it so the fresh answer below can be stored
+            print(f"[WARN] invalid cached annotation for {doc['doc_id']}, re-annotating: {e}")
+            cache.delete(key)
+
     state = {"row": doc, "attempt": 0, "max_retries": max_retries}
-    result = graph.invoke(state)
+    result = await graph.ainvoke(state)
     parsed = result.get("parsed")
     attempts = int(result.get("attempt", 0))
     error = (result.get("error") or "").strip() or None
-    return to_output_row(doc, parsed, annotator=annotator, attempts=attempts, error=error)
+    if parsed and cache is not None:
+        cache.put(key, parsed)
+    return parsed, attempts, error
+
+
+async def annotate_all(graph, docs: list[dict], sink: AnnotationSink, max_inflight: int,
+                       max_retries: int, annotator: str, cache: LLMCache | None) -> None:
+    """
+    All docs are scheduled on one event loop; the semaphore bounds docs in flight,
+    the request rate itself is left to the graph's token bucket.
+    Docs with identical text (reposts, one article under several events) are annotated once
+    and the result is written for every doc_id of the group.
+    Rows are written by this coroutine only, as results arrive.
+    """
+    groups: dict[tuple[str, str], list[dict]] = defaultdict(list)
+    for d in docs:
+        groups[(d["source_type"], d["doc_hash"])].append(d)
+
+    sem = asyncio.Semaphore(max_inflight)
+
+    async def worker(group: list[dict]):
+        async with sem:
+            try:
+                return group, await process_one(graph, group[0], max_retries, cache)
+            except Exception as e:
+                return group, e
+
+    tasks = [asyncio.ensure_future(worker(g)) for g in groups.values()]
+    with tqdm(total=len(docs), desc="Annotating") as bar:
+        for fut in asyncio.as_completed(tasks):
+            group, result = await fut
+            bar.update(len(group))
+            if isinstance(result, Exception):
+                # no row is written, so these docs are retried on the next (resumed) run
+                print(f"[ERROR] worker failed for {', '.join(d['doc_id'] for d in group)}: {result}")
+                continue
+            parsed, attempts, error = result
+            try:
+                rows = [to_output_row(d, parsed, annotator=annotator, attempts=attempts, error=error)
+                        for d in group]
+            except Exception as e:
+                # parsed is validated (cache hits too), so this is not expected; nothing is written
+                # for the group and the docs are annotated again on the next run
+                print(f"[ERROR] bad annotation for {', '.join(d['doc_id'] for d in group)}: {e}")
+                continue
+            for row in rows:
+                sink.add(row)
 
 
 def main():
@@ -144,6 +247,10 @@ def main():
     ap.add_argument("--config", default="configs/annotate.yaml")
     ap.add_argument("--input", default=None)
     ap.add_argument("--out", default=None)
+    ap.add_argument("--max_inflight", "--concurrency", dest="max_inflight", type=int, default=None,
+                    help="Docs annotated concurrently (overrides annotation.max_inflight). The request rate is "
+                         "capped by gigachat.request_sleep_sec anyway; more in flight hides slow answers, "
+                         "but a larger backlog of retries piles up when the API returns 429")
     args = ap.parse_args()
 
     cfg = load_config(args.config)
@@ -161,48 +268,80 @@ def main():
 
     docs = load_documents(df, colmap=colmap, max_chars=max_chars)
 
-    # Add per-doc throttling and retry settings (passed through state row)
-    sleep_sec = float(cfg.get("gigachat", {}).get("request_sleep_sec", 1.5))
+    # Add per-doc retry settings (passed through state row)
     req_retries = int(cfg.get("gigachat", {}).get("request_retries", 4))
     backoff_base = float(cfg.get("gigachat", {}).get("backoff_base_sec", 5.0))
 
     for d in docs:
-        d["_sleep_sec"] = sleep_sec
         d["_request_retries"] = req_retries
         d["_backoff_base_sec"] = backoff_base
 
         # sanitize text_focus further (it already contains title/lead/text)
         d["text_focus"] = _sanitize_text_for_llm(d["text_focus"])
 
-    # Resume
-    done = read_existing_annotations(out_path)
-    docs = [d for d in docs if d["doc_id"] not in done]
+    # Boilerplate repeated across many docs of the batch costs tokens in every prompt: cut it
+    boilerplate = find_boilerplate_lines(
+        [d["text_focus"] for d in docs],
+        min_share=float(cfg["annotation"].get("boilerplate_min_share", 0.3)),
+        min_docs=int(cfg["annotation"].get("boilerplate_min_docs", 20)),
+    )
+    for d in docs:
+        d["text_focus"] = _drop_boilerplate_lines(d["text_focus"], boilerplate)
+        # hash of the final prompt text: identical texts (reposts, one article under
+        # several events) are grouped into one LLM call
+        d["doc_hash"] = text_hash(d["text_focus"])
 
-    llm = init_llm(cfg)
-    graph = make_graph(llm)
+    # Resume (and drop repeated doc_ids of the input: the first row wins, as in the output)
+    done = read_existing_annotations(out_path)
+    docs_by_id: dict[str, dict] = {}
+    for d in docs:
+        docs_by_id.setdefault(d["doc_id"], d)
+    if len(docs_by_id) < len(docs):
+        print(f"Skipped {len(docs) - len(docs_by_id)} rows with a repeated doc_id")
+    docs = [d for doc_id, d in docs_by_id.items() if doc_id not in done]
 
     max_retries = int(cfg["annotation"].get("max_retries", 3))
 
-    # IMPORTANT: to avoid 429, default concurrency=1
-    concurrency = int(cfg["annotation"].get("concurrency", 1))
+    # 429s are avoided by the token bucket, so many small in-flight requests are fine
+    # (annotation.concurrency is the old name of the setting)
+    max_inflight = args.max_inflight or int(
+        cfg["annotation"].get("max_inflight", cfg["annotation"].get("concurrency", DEFAULT_MAX_INFLIGHT))
+    )
     annotator = str(cfg["annotation"].get("annotator_name", "gigachat_llm"))
 
     if not docs:
         print("No new documents to annotate.")
         return
 
+    # One token bucket for all workers: on average one request per request_sleep_sec
+    sleep_sec = float(cfg.get("gigachat", {}).get("request_sleep_sec", 1.5))
+    burst = int(cfg.get("gigachat", {}).get("request_burst", 1))
+    limiter = TokenBucket(rate=1.0 / sleep_sec, burst=burst) if sleep_sec > 0 else None
+
+    # One client (and graph) per run, shared by all workers: the SDK keeps a single
+    # httpx AsyncClient per GigaChat instance, so the TLS connections and the token are reused
+    llm = init_llm(cfg)
+    graph = make_graph(llm, limiter=limiter)
+
+    # Cache of parsed annotations (empty cache_path disables it).
+    # A cached answer is only a valid replay of a deterministic call, so temperature must be 0.
+    cache = None
+    cache_path = cfg["annotation"].get("cache_path")
+    temperature = float(cfg["gigachat"].get("temperature", 0.0))
+    if cache_path and temperature == 0.0:
+        cache = LLMCache(cache_path, model=str(cfg["gigachat"].get("model", "GigaChat")), temperature=temperature)
+    elif cache_path:
+        print(f"LLM cache disabled: temperature={temperature} (needs 0.0)")
+
     # Process with safe exception handling: NEVER crash the whole run
-    with ThreadPoolExecutor(max_workers=concurrency) as ex:
-        futs = [ex.submit(process_one, graph, d, max_retries, annotator) for d in docs]
-        for fut in tqdm(as_completed(futs), total=len(futs), desc="Annotating"):
-            try:
-                row = fut.result()
-            except Exception as e:
-                # fallback: we don't know which doc, so we can't append a proper row
-                # but at least we print and continue
-                print(f"[ERROR] worker failed: {e}")
-                continue
-            append_output_row(out_path, row)
+    sink = AnnotationSink(out_path)
+    try:
+        asyncio.run(annotate_all(graph, docs, sink, max_inflight, max_retries, annotator, cache))
+    finally:
+        # written rows are what resume relies on, so drain the buffer even on Ctrl+C
+        sink.close()
+        if cache is not None:
+            cache.close()
 
     print(f"Saved: {out_path}")
 
@@ -1,10 +1,11 @@
 from __future__ import annotations
 
-from typing import List, Literal, Optional
+from typing import List, Literal, Optional, get_args
 from pydantic import BaseModel, Field
 
 
 Stance = Literal["hawkish", "dovish", "neutral", "mixed", "irrelevant"]
+STANCES = frozenset(get_args(Stance))
 
 
 class LLMAnnotation(BaseModel):
@@ -21,6 +22,10 @@ class LLMAnnotation(BaseModel):
 
 
 class OutputRow(BaseModel):
+    """
+    Строка выходного CSV. В run.to_output_row строка собирается обычным dict
+    (без валидации на каждую запись) — порядок и типы полей должны совпадать.
+    """
     # метаданные из входа
     event_id: str
     doc_id: str
@@ -5,54 +5,69 @@ import csv
 from pathlib import Path
 import pandas as pd
 import numpy as np
-
-from openpyxl.styles import Alignment
-from openpyxl.utils import get_column_letter
+import pyarrow as pa
+from pyarrow import csv as pacsv
 
 
 # -----------------------------
 # Robust readers
 # -----------------------------
 
+ANNOTATION_COLUMNS = ["event_id", "doc_id", "source_type", "source_name", "published_at", "title",
+                      "stance", "strength", "mentions_key_rate", "status", "evidence", "reasons"]
+
+
+def _skip_invalid_row(row) -> str:
+    # tolerate broken CSV quoting (just in case): drop rows with a wrong column count
+    return "skip"
+
+
+def _read_csv(path: Path, columns: list[str], text_columns: tuple[str, ...] = ()) -> pd.DataFrame:
+    """
+    CSV via pyarrow's multithreaded parser; only `columns` present in the header are
+    materialized, `text_columns` stay strings (no id/date inference).
+    """
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        header = next(csv.reader(f), [])
+    wanted = set(columns)
+    table = pacsv.read_csv(
+        path,
+        read_options=pacsv.ReadOptions(use_threads=True, block_size=8 << 20),
+        parse_options=pacsv.ParseOptions(newlines_in_values=True, invalid_row_handler=_skip_invalid_row),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=[c for c in header if c in wanted],
+            strings_can_be_null=True,
+            column_types={c: pa.string() for c in text_columns if c in header},
+        ),
+    )
+    return table.to_pandas()
+
+
 def read_annotations(path: str) -> pd.DataFrame:
     p = Path(path)
     if p.suffix.lower() in [".xlsx", ".xls"]:
-        df = pd.read_excel(p)
+        df = pd.read_excel(p, usecols=lambda c: c in ANNOTATION_COLUMNS)
     else:
-        # tolerate broken CSV quoting (just in case)
-        try:
-            df = pd.read_csv(p, encoding="utf-8-sig")
-        except Exception:
-            df = pd.read_csv(
-                p,
-                encoding="utf-8-sig",
-                engine="python",
-                sep=",",
-                quoting=csv.QUOTE_MINIMAL,
-                on_bad_lines="skip",
-            )
+        df = _read_csv(p, ANNOTATION_COLUMNS, text_columns=("event_id", "doc_id", "published_at"))
 
     # normalize expected columns
-    for col in ["event_id", "doc_id", "source_type", "source_name", "published_at", "title",
-                "stance", "strength", "mentions_key_rate", "status", "evidence", "reasons"]:
+    for col in ANNOTATION_COLUMNS:
         if col not in df.columns:
             df[col] = np.nan
 
-    df["event_id"] = df["event_id"].astype(str)
-    df["doc_id"] = df["doc_id"].astype(str)
-    df["source_type"] = df["source_type"].astype(str).str.lower()
-    df["source_name"] = df["source_name"].astype(str)
-    df["stance"] = df["stance"].astype(str).str.lower()
-    df["status"] = df["status"].astype(str).str.lower()
+    df = df.astype({"event_id": "string", "doc_id": "string", "source_name": "string"})
+    df["source_name"] = df["source_name"].fillna("")
+    # low-cardinality fields: categorical (int codes instead of one string per row)
+    for col in ("source_type", "stance", "status"):
+        df[col] = df[col].astype("string").str.lower().fillna("").astype("category")
 
-    df["published_at"] = pd.to_datetime(df["published_at"], errors="coerce")
+    df["published_at"] = pd.to_datetime(df["published_at"], errors="coerce", cache=True)
     df["mentions_key_rate"] = df["mentions_key_rate"].fillna(False).astype(bool)
     df["strength"] = pd.to_numeric(df["strength"], errors="coerce")
 
     # Clean strings
-    df["title"] = df["title"].fillna("").astype(str).str.strip()
-    df["evidence"] = df["evidence"].fillna("").astype(str).str.strip()
-    df["reasons"] = df["reasons"].fillna("").astype(str).str.strip()
+    for col in ("title", "evidence", "reasons"):
+        df[col] = df[col].astype("string").fillna("").str.strip()
 
     return df
 
@@ -87,32 +102,31 @@ def select_events(mdi: pd.DataFrame, max_cases: int) -> list[str]:
       3) low coverage (n_media_used < 4)
       4) fallback: first events by date
     """
-    df = mdi.copy()
-
-    # normalize
-    df["divergence_stance_num"] = pd.to_numeric(df["divergence_stance"], errors="coerce")
-    df["n_media_used_num"] = pd.to_numeric(df["n_media_used"], errors="coerce")
+    # normalize once
+    event_ids = mdi["event_id"]
+    divergence = pd.to_numeric(mdi["divergence_stance"], errors="coerce")
+    n_media_used = pd.to_numeric(mdi["n_media_used"], errors="coerce")
+    media_stance = mdi["media_stance"].astype("string").str.lower()
 
     picked: list[str] = []
+    picked_set: set[str] = set()
 
-    def take(mask):
-        nonlocal picked
-        cand = df.loc[mask, "event_id"].dropna().astype(str).tolist()
-        for e in cand:
-            if e not in picked:
-                picked.append(e)
+    def take(ids: pd.Series):
+        for e in ids.dropna().astype(str):
             if len(picked) >= max_cases:
                 break
+            if e not in picked_set:
+                picked.append(e)
+                picked_set.add(e)
 
-    take(df["divergence_stance_num"].eq(1))
+    take(event_ids[divergence.eq(1)])
     if len(picked) < max_cases:
-        take(df["media_stance"].astype(str).str.lower().eq("mixed"))
+        take(event_ids[media_stance.eq("mixed").fillna(False)])
     if len(picked) < max_cases:
-        take(df["n_media_used_num"].lt(4))
+        take(event_ids[n_media_used.lt(4)])
     if len(picked) < max_cases:
         # fallback by date
-        df2 = df.sort_values("event_date_time")
-        take(df2["event_id"].notna())
+        take(mdi.sort_values("event_date_time")["event_id"])
 
     return picked[:max_cases]
 
@@ -123,25 +137,30 @@ def select_events(mdi: pd.DataFrame, max_cases: int) -> list[str]:
 
 def build_media_flags(media: pd.DataFrame) -> pd.DataFrame:
     m = media.copy()
-    m["ok"] = m["status"].eq("ok")
-    m["usable"] = m["ok"] & m["mentions_key_rate"] & ~m["stance"].isin(["irrelevant"])
-
-    m["excluded_reason"] = ""
-    m.loc[~m["ok"], "excluded_reason"] = "status_not_ok"
-    m.loc[m["ok"] & ~m["mentions_key_rate"], "excluded_reason"] = "mentions_key_rate_false"
-    m.loc[m["ok"] & m["mentions_key_rate"] & m["stance"].isin(["irrelevant"]), "excluded_reason"] = "stance_irrelevant"
-    m.loc[m["usable"], "excluded_reason"] = ""
-
-    m["is_used_in_media_signal"] = m["usable"].astype(bool)
+    ok = m["status"].eq("ok").to_numpy(dtype=bool)
+    mkr = m["mentions_key_rate"].to_numpy(dtype=bool)
+    irr = m["stance"].isin(["irrelevant"]).to_numpy(dtype=bool)
+    usable = ok & mkr & ~irr
+
+    m["ok"] = ok
+    m["usable"] = usable
+    m["excluded_reason"] = np.select(
+        [~ok, ~mkr, irr],
+        ["status_not_ok", "mentions_key_rate_false", "stance_irrelevant"],
+        default="",
+    )
+    m["is_used_in_media_signal"] = usable
     return m
 
 
-def short_evidence(evidence: str, max_items: int = 2) -> str:
-    if not evidence:
-        return ""
+def short_evidence(evidence: pd.Series, max_items: int = 2) -> pd.Series:
+    """First `max_items` non-empty evidence parts per row (index must be unique)."""
     # evidence in your pipeline is "a ||| b ||| c"
-    parts = [p.strip() for p in evidence.split("|||") if p.strip()]
-    return " ||| ".join(parts[:max_items])
+    parts = evidence.fillna("").astype("string").str.split("|||", regex=False).explode().str.strip()
+    parts = parts[parts.ne("").fillna(False)]
+    head = parts.groupby(level=0, sort=False).head(max_items)
+    joined = head.groupby(level=0, sort=False).agg(" ||| ".join)
+    return joined.reindex(evidence.index, fill_value="")
 
 
 def build_outputs(mdi: pd.DataFrame, ann: pd.DataFrame, selected_events: list[str]) -> tuple[pd.DataFrame, pd.DataFrame, str]:
@@ -154,19 +173,15 @@ def build_outputs(mdi: pd.DataFrame, ann: pd.DataFrame, selected_events: list[st
     cases = mdi[mdi["event_id"].isin(selected_events)].copy()
 
     # readable takeaway (auto)
-    def takeaway(r):
-        o = str(r.get("official_stance", "")).lower()
-        m = str(r.get("media_stance", "")).lower()
-        d = r.get("divergence_stance", np.nan)
-        if pd.isna(d):
-            return "Недостаточно данных для оценки расхождения"
-        if float(d) == 0:
-            return f"Согласие: ЦБ={o}, СМИ={m}"
-        if float(d) == 1:
-            return f"Расхождение: ЦБ={o}, СМИ={m}"
-        return ""
-
-    cases["takeaway"] = cases.apply(takeaway, axis=1)
+    o = cases["official_stance"].astype("string").fillna("na").str.lower()
+    m = cases["media_stance"].astype("string").fillna("na").str.lower()
+    d = pd.to_numeric(cases["divergence_stance"], errors="coerce")
+    pair = ("ЦБ=" + o + ", СМИ=" + m).to_numpy(dtype=object)
+    cases["takeaway"] = np.select(
+        [d.isna().to_numpy(), d.eq(0).to_numpy(), d.eq(1).to_numpy()],
+        ["Недостаточно данных для оценки расхождения", "Согласие: " + pair, "Расхождение: " + pair],
+        default="",
+    )
 
     # keep only useful columns
     keep_cases = [
@@ -192,7 +207,7 @@ def build_outputs(mdi: pd.DataFrame, ann: pd.DataFrame, selected_events: list[st
     docs["is_used_in_media_signal"] = docs["is_used_in_media_signal"].fillna(False).astype(bool)
 
     # shorten evidence to make xlsx readable
-    docs["evidence_short"] = docs["evidence"].apply(lambda x: short_evidence(str(x), max_items=2))
+    docs["evidence_short"] = short_evidence(docs["evidence"], max_items=2)
 
     keep_docs = [
         "event_id", "doc_id", "source_type", "source_name", "published_at",
@@ -209,33 +224,39 @@ def build_outputs(mdi: pd.DataFrame, ann: pd.DataFrame, selected_events: list[st
     md_lines.append("# Шаг 5 — кейсы Media Divergence Index\n")
     md_lines.append(f"Выбрано кейсов: {len(selected_events)}\n")
 
-    for _, r in cases.sort_values("event_date_time").iterrows():
-        eid = r["event_id"]
+    # docs of each event, split once instead of a boolean scan per case
+    docs_by_event = dict(list(docs.groupby("event_id", sort=False)))
+    no_docs = docs.iloc[:0]
+
+    for r in cases.sort_values("event_date_time").itertuples(index=False, name="Case"):
+        eid = r.event_id
         md_lines.append(f"\n## {eid}\n")
-        if "event_date_time" in cases.columns and pd.notna(r.get("event_date_time", None)):
-            md_lines.append(f"- Дата: {pd.to_datetime(r['event_date_time']).date()}\n")
+        if "event_date_time" in cases.columns and pd.notna(r.event_date_time):
+            md_lines.append(f"- Дата: {pd.to_datetime(r.event_date_time).date()}\n")
         if "decision" in cases.columns:
-            md_lines.append(f"- Решение: {r.get('decision','')}\n")
+            md_lines.append(f"- Решение: {getattr(r, 'decision', '')}\n")
         if "new_rate" in cases.columns:
-            md_lines.append(f"- Новая ставка: {r.get('new_rate','')}\n")
+            md_lines.append(f"- Новая ставка: {getattr(r, 'new_rate', '')}\n")
 
-        md_lines.append(f"- ЦБ stance: **{r.get('official_stance','')}**\n")
-        md_lines.append(f"- СМИ stance: **{r.get('media_stance','')}**\n")
-        md_lines.append(f"- Divergence: **{r.get('divergence_stance','')}**\n")
-        md_lines.append(f"- Покрытие СМИ (used): {r.get('n_media_used','')}, relevance_rate: {r.get('media_relevance_rate','')}\n")
-        md_lines.append(f"- Итог: {r.get('takeaway','')}\n")
+        md_lines.append(
+            f"- ЦБ stance: **{getattr(r, 'official_stance', '')}**\n"
+            f"- СМИ stance: **{getattr(r, 'media_stance', '')}**\n"
+            f"- Divergence: **{getattr(r, 'divergence_stance', '')}**\n"
+            f"- Покрытие СМИ (used): {getattr(r, 'n_media_used', '')}, relevance_rate: {getattr(r, 'media_relevance_rate', '')}\n"
+            f"- Итог: {getattr(r, 'takeaway', '')}\n"
+            "\n### Документы\n"
+        )
 
         # add small doc listing
-        sub = docs[docs["event_id"] == eid].copy()
-        md_lines.append("\n### Документы\n")
-        for _, d in sub.iterrows():
-            src = d.get("source_type", "")
-            name = d.get("source_name", "")
-            title = d.get("title", "")
-            stance = d.get("stance", "")
-            used = d.get("is_used_in_media_signal", False)
-            excl = d.get("excluded_reason", "")
-            ev = d.get("evidence_short", "")
+        sub = docs_by_event.get(eid, no_docs)
+        for d in sub.itertuples(index=False, name="Doc"):
+            src = getattr(d, "source_type", "")
+            name = getattr(d, "source_name", "")
+            title = getattr(d, "title", "")
+            stance = getattr(d, "stance", "")
+            used = getattr(d, "is_used_in_media_signal", False)
+            excl = getattr(d, "excluded_reason", "")
+            ev = getattr(d, "evidence_short", "")
 
             flag = "USED" if used else ("EXCL:" + excl if excl else "—")
             md_lines.append(f"- [{src}/{name}] **{stance}** ({flag}) — {title}\n")
@@ -250,55 +271,38 @@ def build_outputs(mdi: pd.DataFrame, ann: pd.DataFrame, selected_events: list[st
 # Excel writer
 # -----------------------------
 
-def _set_auto_filter_and_freeze(ws):
-    ws.freeze_panes = "A2"
-    ws.auto_filter.ref = ws.dimensions
-
-
-def _auto_fit_columns(ws, max_width: int = 70):
-    for col_idx, col_cells in enumerate(ws.columns, start=1):
-        max_len = 0
-        for cell in col_cells:
-            v = cell.value
-            if v is None:
-                continue
-            s = str(v)
-            if len(s) > max_len:
-                max_len = len(s)
-        width = min(max_len + 2, max_width)
-        ws.column_dimensions[get_column_letter(col_idx)].width = max(10, width)
-
-
-def _wrap_columns(ws, col_names: list[str]):
-    header = [c.value for c in next(ws.iter_rows(min_row=1, max_row=1))]
-    name_to_idx = {name: i for i, name in enumerate(header, start=1)}
-    for name in col_names:
-        idx = name_to_idx.get(name)
-        if not idx:
-            continue
-        for row in ws.iter_rows(min_row=2, min_col=idx, max_col=idx):
-            for cell in row:
-                cell.alignment = Alignment(wrap_text=True, vertical="top")
+def _column_widths(df: pd.DataFrame, max_width: int = 70) -> list[int]:
+    """Width = longest header/value of each column, measured on the DataFrame (not cell by cell)."""
+    widths = []
+    for col in df.columns:
+        s = df[col]
+        s = s[s.notna()]
+        max_len = int(s.astype(str).str.len().max()) if len(s) else 0
+        max_len = max(max_len, len(str(col)))
+        widths.append(max(10, min(max_len + 2, max_width)))
+    return widths
+
+
+def _format_sheet(ws, df: pd.DataFrame, wrap_cols: list[str], wrap_fmt, max_width: int):
+    ws.freeze_panes(1, 0)
+    ws.autofilter(0, 0, len(df), max(len(df.columns) - 1, 0))
+    for i, (col, width) in enumerate(zip(df.columns, _column_widths(df, max_width=max_width))):
+        ws.set_column(i, i, width, wrap_fmt if col in wrap_cols else None)
 
 
 def write_xlsx(cases: pd.DataFrame, docs: pd.DataFrame, out_path: str):
     out = Path(out_path)
     out.parent.mkdir(parents=True, exist_ok=True)
 
-    with pd.ExcelWriter(out, engine="openpyxl") as writer:
+    # no constant_memory: pandas writes column by column, that mode keeps only the current row
+    with pd.ExcelWriter(out, engine="xlsxwriter") as writer:
         cases.to_excel(writer, sheet_name="cases", index=False)
         docs.to_excel(writer, sheet_name="docs", index=False)
 
-        ws1 = writer.sheets["cases"]
-        ws2 = writer.sheets["docs"]
-        _set_auto_filter_and_freeze(ws1)
-        _set_auto_filter_and_freeze(ws2)
-
-        _wrap_columns(ws1, ["official_top_reasons", "media_top_reasons", "takeaway"])
-        _wrap_columns(ws2, ["title", "evidence_short"])
-
-        _auto_fit_columns(ws1, max_width=55)
-        _auto_fit_columns(ws2, max_width=80)
+        wrap = writer.book.add_format({"text_wrap": True, "valign": "top"})
+        _format_sheet(writer.sheets["cases"], cases, ["official_top_reasons", "media_top_reasons", "takeaway"],
+                      wrap, max_width=55)
+        _format_sheet(writer.sheets["docs"], docs, ["title", "evidence_short"], wrap, max_width=80)
 
 
 # -----------------------------